@@ -1,228 +1,383 @@
+import io
 import os
 import sys
+import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
-import exifread
+from typing import Callable
+from PIL import Image, ImageDraw, ImageFont, UnidentifiedImageError
 
-def get_exif_datetime(image_path):
-    """从图片中读取EXIF信息中的拍摄时间"""
+# 水印参数的默认值
+DEFAULT_FONT_SIZE = 20
+DEFAULT_FONT_COLOR = 'white'
+DEFAULT_POSITION = 'bottom_right'
+DEFAULT_OPACITY = 128
+
+# 支持的图片扩展名
+IMAGE_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff'})
+# 能够保存透明通道的输出扩展名
+ALPHA_EXTS = frozenset({'.png', '.bmp', '.gif', '.tiff'})
+# 各格式保存时使用的编码参数：JPEG跳过第二遍Huffman优化，PNG使用最快的压缩级别
+SAVE_OPTIONS = {
+    '.jpg': {'quality': 90, 'subsampling': 2, 'progressive': False, 'optimize': False},
+    '.jpeg': {'quality': 90, 'subsampling': 2, 'progressive': False, 'optimize': False},
+    '.png': {'compress_level': 1},
+}
+# 目录处理时提前预读的文件数量
+PREFETCH_DEPTH = 16
+# 目录处理时的工作线程数，以及同时提交但未完成的最大任务数
+MAX_WORKERS = 4
+MAX_IN_FLIGHT = 8
+
+# 支持的颜色英文名称
+NAMED_COLORS = {
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+    'red': (255, 0, 0),
+    'green': (0, 255, 0),
+    'blue': (0, 0, 255),
+}
+
+# 各水印位置对应的坐标计算函数，参数为(图片宽, 图片高, 文本宽, 文本高)
+POSITIONS = {
+    'top_left': lambda w, h, tw, th: (10, 10),
+    'top_right': lambda w, h, tw, th: (w - tw - 10, 10),
+    'bottom_left': lambda w, h, tw, th: (10, h - th - 10),
+    'bottom_right': lambda w, h, tw, th: (w - tw - 10, h - th - 10),
+    'center': lambda w, h, tw, th: ((w - tw) // 2, (h - th) // 2),
+}
+
+@dataclass(slots=True)
+class WatermarkJob:
+    """一批图片共用的水印参数，在main中解析一次后传给各个处理函数"""
+    font: ImageFont.FreeTypeFont
+    fill: tuple
+    position_fn: Callable
+    out_dir: str
+    max_dim: int | None = None
+
+def get_exif_datetime(image, image_path, source=None):
+    """从已打开图片的EXIF信息中读取拍摄时间，没有时使用文件的修改时间，source为图片对应的已打开文件对象"""
     try:
-        with open(image_path, 'rb') as f:
-            tags = exifread.process_file(f)
-            
-            # 尝试不同的EXIF标签获取拍摄时间
-            datetime_tags = ['EXIF DateTimeOriginal', 'EXIF DateTimeDigitized', 'Image DateTime']
-            for tag in datetime_tags:
-                if tag in tags:
-                    # 将EXIF时间格式（YYYY:MM:DD HH:MM:SS）转换为Python datetime对象
-                    date_str = str(tags[tag])
-                    try:
-                        return datetime.strptime(date_str, '%Y:%m:%d %H:%M:%S')
-                    except ValueError:
-                        continue
-            
-            # 如果没有找到EXIF时间，使用文件的修改时间
-            file_mtime = os.path.getmtime(image_path)
-            return datetime.fromtimestamp(file_mtime)
+        exif = image.getexif()
+        # DateTimeOriginal和DateTimeDigitized位于Exif子IFD中，DateTime位于主IFD中
+        exif_ifd = exif.get_ifd(0x8769)
+        for date_str in (exif_ifd.get(0x9003), exif_ifd.get(0x9004), exif.get(0x0132)):
+            if date_str:
+                # 将EXIF时间格式（YYYY:MM:DD HH:MM:SS）转换为Python datetime对象
+                try:
+                    return datetime.strptime(str(date_str).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+                except ValueError:
+                    continue
+        
+        # 如果没有找到EXIF时间，使用文件的修改时间；已有打开的文件时对其fstat，不再按路径查找
+        file_mtime = os.fstat(source.fileno()).st_mtime if source is not None else os.path.getmtime(image_path)
+        return datetime.fromtimestamp(file_mtime)
     except Exception as e:
-        print(f"无法读取{image_path}的EXIF信息: {e}")
+        print(f"无法读取{image_path}的EXIF信息: {e}\n", end='')
         # 发生错误时返回当前时间
         return datetime.now()
 
-def add_watermark(image_path, output_path, text, font_size=20, font_color=(255, 255, 255), position='bottom_right', opacity=128):
-    """在图片上添加水印"""
+def parse_fill(font_color_str, opacity):
+    """将颜色名称或RGB字符串与透明度解析为(r, g, b, a)填充色，无效颜色时使用白色"""
+    font_color = NAMED_COLORS.get(font_color_str.lower())
+    if font_color is None:
+        # 尝试解析RGB格式
+        try:
+            font_color = tuple(map(int, font_color_str.split(',')))
+            if len(font_color) != 3 or not all(0 <= c <= 255 for c in font_color):
+                raise ValueError
+        except ValueError:
+            print(f"无效的颜色格式: {font_color_str}，使用默认白色")
+            font_color = NAMED_COLORS['white']
+    return font_color + (opacity,)
+
+@functools.lru_cache(maxsize=8)
+def load_font(font_size):
+    """加载指定大小的水印字体，结果会被缓存以便在多张图片间复用"""
+    # 尝试加载字体，如果失败则使用默认字体
     try:
-        # 打开图片
-        image = Image.open(image_path).convert('RGBA')
-        
-        # 创建一个与原图大小相同的透明图层
-        watermark_layer = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(watermark_layer)
-        
-        # 尝试加载字体，如果失败则使用默认字体
+        # 在Windows上使用完整的Arial字体路径
+        if os.name == 'nt':  # Windows系统
+            font = ImageFont.truetype('C:/Windows/Fonts/arial.ttf', font_size)
+        else:
+            # 非Windows系统尝试其他字体
+            font = ImageFont.truetype('arial.ttf', font_size)
+    except IOError:
+        # 在不同平台上尝试其他常见字体
         try:
-            # 在Windows上使用完整的Arial字体路径
-            if os.name == 'nt':  # Windows系统
-                font = ImageFont.truetype('C:/Windows/Fonts/arial.ttf', font_size)
-            else:
-                # 非Windows系统尝试其他字体
-                font = ImageFont.truetype('arial.ttf', font_size)
+            font = ImageFont.truetype('/System/Library/Fonts/PingFang.ttc', font_size)  # macOS
         except IOError:
-            # 在不同平台上尝试其他常见字体
             try:
-                font = ImageFont.truetype('/System/Library/Fonts/PingFang.ttc', font_size)  # macOS
+                font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', font_size)  # Linux
             except IOError:
+                # 如果都失败，使用默认字体
+                font = ImageFont.load_default()
+                print("警告: 无法加载指定字体，使用默认字体")
+    return font
+
+@functools.lru_cache(maxsize=64)
+def text_bbox(text, font):
+    """计算文本的边界框，同一批图片的日期文本大多相同，结果会被缓存"""
+    return font.getbbox(text)
+
+@functools.lru_cache(maxsize=64)
+def render_text_tile(text, font, fill):
+    """将水印文本渲染为只有文本大小的RGBA小图，相同的文本、字体和颜色只渲染一次"""
+    left, top, right, bottom = text_bbox(text, font)
+    tile = Image.new('RGBA', (max(right - left, 1), max(bottom - top, 1)), (0, 0, 0, 0))
+    ImageDraw.Draw(tile).text((-left, -top), text, font=font, fill=fill)
+    return tile
+
+def save_atomic(image, output_path):
+    """按输出格式的编码参数保存图片：先编码到内存，再写入临时文件后替换，中断时不会留下写了一半的图片"""
+    _, ext = os.path.splitext(output_path.lower())
+    buffer = io.BytesIO()
+    image.save(buffer, format=Image.registered_extensions()[ext], **SAVE_OPTIONS.get(ext, {}))
+    
+    tmp_path = f"{output_path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getbuffer())
+            f.flush()
+            # 输出文件之后不会再读取，提示内核释放其页缓存，把内存留给待处理的源图片
+            # 内核无法丢弃脏页，需先把数据同步到磁盘
+            if hasattr(os, 'posix_fadvise'):
                 try:
-                    font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', font_size)  # Linux
-                except IOError:
-                    # 如果都失败，使用默认字体
-                    font = ImageFont.load_default()
-                    print("警告: 无法加载指定字体，使用默认字体")
-        
-        # 获取文本大小 - 兼容新版Pillow
-        # 注意：Pillow 8.0.0+中textsize方法已废弃，改用getbbox方法
-        try:
-            # 尝试使用font.getbbox (Pillow 8.0.0+)
-            bbox = font.getbbox(text)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-        except AttributeError:
-            # 对于旧版Pillow使用draw.textsize
-            text_width, text_height = draw.textsize(text, font=font)
-        
-        # 根据位置确定文本的放置位置
-        if position == 'top_left':
-            x, y = 10, 10
-        elif position == 'top_right':
-            x, y = image.width - text_width - 10, 10
-        elif position == 'bottom_left':
-            x, y = 10, image.height - text_height - 10
-        elif position == 'center':
-            x, y = (image.width - text_width) // 2, (image.height - text_height) // 2
-        else:  # bottom_right
-            x, y = image.width - text_width - 10, image.height - text_height - 10
-        
-        # 在透明图层上绘制文本
-        draw.text((x, y), text, font=font, fill=font_color + (opacity,))
-        
-        # 将透明图层与原图合并
-        combined = Image.alpha_composite(image, watermark_layer)
+                    os.fdatasync(f.fileno())
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                except OSError:
+                    # 释放页缓存只是优化，失败时忽略
+                    pass
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        # 写入失败时清理临时文件
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def add_watermark(image_path, output_path, job, source=None):
+    """按job中的参数在图片上添加以拍摄日期为内容的水印，source为调用方已打开的文件对象"""
+    try:
+        # 调用方已打开文件时直接使用，否则按路径打开
+        if source is None:
+            source = open(image_path, 'rb')
         
-        # 保存结果图片
-        combined.convert('RGB').save(output_path)
-        print(f"已保存带水印的图片到: {output_path}")
+        # 打开图片，处理完成后立即关闭文件并释放解码缓冲区，避免在线程池中堆积
+        with source, Image.open(source) as image:
+            # 复用已打开的图片读取拍摄时间作为水印文本
+            text = get_exif_datetime(image, image_path, source).strftime('%Y-%m-%d')
+            
+            # 需要缩小输出时，先用draft让JPEG解码器直接按1/2、1/4、1/8比例解码，再缩放到目标尺寸
+            if job.max_dim and max(image.size) > job.max_dim:
+                image.draft('RGB', (job.max_dim, job.max_dim))
+                image.thumbnail((job.max_dim, job.max_dim))
+            
+            # 带透明信息的图片在输出格式支持时统一为RGBA以保留透明度，其余统一为RGB，JPEG等RGB图片无需转换
+            _, ext = os.path.splitext(output_path.lower())
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            target_mode = 'RGBA' if has_alpha and ext in ALPHA_EXTS else 'RGB'
+            if image.mode != target_mode:
+                image = image.convert(target_mode)
+            
+            # 水印文本渲染成的小图在同一批图片间复用
+            tile = render_text_tile(text, job.font, job.fill)
+            left, top, _, _ = text_bbox(text, job.font)
+            
+            # 根据位置确定文本的放置位置
+            x, y = job.position_fn(image.width, image.height, tile.width, tile.height)
+            
+            dx, dy = x + left, y + top
+            if image.mode == 'RGB':
+                # 以文本小图的透明度为蒙版粘贴，只混合文本所在区域
+                image.paste(tile, (dx, dy), tile)
+            else:
+                # RGBA图片需要连同透明通道一起合成，同样只处理文本所在区域
+                # alpha_composite不接受负的目标坐标，超出左上边界的部分从文本小图中裁掉
+                image.alpha_composite(tile, (max(dx, 0), max(dy, 0)), (max(-dx, 0), max(-dy, 0)))
+            
+            # 保存结果图片
+            save_atomic(image, output_path)
+        # 工作线程中换行符与内容一起输出，避免多线程输出挤在同一行
+        print(f"已保存带水印的图片到: {output_path}\n", end='')
         return True
+    except UnidentifiedImageError:
+        # 从文件对象打开时Pillow的错误信息只包含文件对象，这里改为显示路径
+        print(f"处理{image_path}时出错: cannot identify image file {image_path!r}\n", end='')
+        return False
     except Exception as e:
-        print(f"处理{image_path}时出错: {e}")
+        print(f"处理{image_path}时出错: {e}\n", end='')
         return False
 
-def main():
+def prompt_args():
+    """交互式询问各项参数，用户直接按回车则使用默认值"""
     print("===== 图片水印工具 =====")
     
     # 使用input获取用户输入
     image_path = input("请输入图片文件或目录路径: ").strip()
     
-    # 默认值
-    default_font_size = 20
-    default_font_color = 'white'
-    default_position = 'bottom_right'
-    default_opacity = 128
-    
     # 获取可选参数，用户直接按回车则使用默认值
-    font_size_input = input(f"请输入水印字体大小 (默认: {default_font_size}): ").strip()
-    font_size = int(font_size_input) if font_size_input else default_font_size
+    font_size_input = input(f"请输入水印字体大小 (默认: {DEFAULT_FONT_SIZE}): ").strip()
+    font_size = int(font_size_input) if font_size_input else DEFAULT_FONT_SIZE
+    
+    font_color_input = input(f"请输入水印字体颜色 (默认: {DEFAULT_FONT_COLOR}, 支持英文名称或RGB格式如255,255,255): ").strip()
+    font_color_str = font_color_input if font_color_input else DEFAULT_FONT_COLOR
+    
+    position_input = input(f"请输入水印位置 (默认: {DEFAULT_POSITION}, 可选值: {', '.join(POSITIONS)}): ").strip()
+    position = position_input if position_input else DEFAULT_POSITION
+    
+    opacity_input = input(f"请输入水印透明度 (默认: {DEFAULT_OPACITY}, 范围: 0-255): ").strip()
+    opacity = int(opacity_input) if opacity_input else DEFAULT_OPACITY
     
-    font_color_input = input(f"请输入水印字体颜色 (默认: {default_font_color}, 支持英文名称或RGB格式如255,255,255): ").strip()
-    font_color_str = font_color_input if font_color_input else default_font_color
+    max_dim_input = input("请输入输出图片最大边长 (默认: 不缩放): ").strip()
+    max_dim = int(max_dim_input) if max_dim_input else None
     
-    position_input = input(f"请输入水印位置 (默认: {default_position}, 可选值: top_left, top_right, bottom_left, bottom_right, center): ").strip()
-    position = position_input if position_input else default_position
+    return argparse.Namespace(path=image_path, font_size=font_size, color=font_color_str,
+                              position=position, opacity=opacity, max_dim=max_dim)
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="给图片添加基于EXIF拍摄时间的水印")
+    parser.add_argument('path', help="图片文件或目录路径")
+    parser.add_argument('--font-size', type=int, default=DEFAULT_FONT_SIZE, help=f"水印字体大小 (默认: {DEFAULT_FONT_SIZE})")
+    parser.add_argument('--color', default=DEFAULT_FONT_COLOR, help=f"水印字体颜色，支持英文名称或RGB格式如255,255,255 (默认: {DEFAULT_FONT_COLOR})")
+    parser.add_argument('--position', default=DEFAULT_POSITION, help=f"水印位置，可选值: {', '.join(POSITIONS)} (默认: {DEFAULT_POSITION})")
+    parser.add_argument('--opacity', type=int, default=DEFAULT_OPACITY, help=f"水印透明度，范围: 0-255 (默认: {DEFAULT_OPACITY})")
+    parser.add_argument('--max-dim', type=int, default=None, help="输出图片最大边长 (默认: 不缩放)")
+    return parser.parse_args(argv)
+
+def main():
+    # 在终端中不带参数运行时使用交互式输入，否则读取命令行参数，便于脚本和xargs -P等批量调用
+    if len(sys.argv) == 1 and sys.stdin.isatty():
+        args = prompt_args()
+    else:
+        args = parse_args()
     
-    opacity_input = input(f"请输入水印透明度 (默认: {default_opacity}, 范围: 0-255): ").strip()
-    opacity = int(opacity_input) if opacity_input else default_opacity
+    # 规范化路径，去掉末尾的斜杠，否则basename为空，输出目录名会变成“_watermark”
+    image_path = os.path.normpath(args.path) if args.path else args.path
+    font_size = args.font_size
+    font_color_str = args.color
+    position = args.position
+    opacity = args.opacity
+    max_dim = args.max_dim
     
     # 验证位置参数
-    valid_positions = ['top_left', 'top_right', 'bottom_left', 'bottom_right', 'center']
-    if position not in valid_positions:
+    if position not in POSITIONS:
         print(f"警告: 无效的位置值 '{position}'，使用默认值 'bottom_right'")
-        position = default_position
+        position = DEFAULT_POSITION
     
     # 验证透明度参数
     if not (0 <= opacity <= 255):
-        print(f"警告: 透明度值 {opacity} 超出范围，使用默认值 {default_opacity}")
-        opacity = default_opacity
-    
-    # 处理字体颜色参数
-    if font_color_str.lower() == 'white':
-        font_color = (255, 255, 255)
-    elif font_color_str.lower() == 'black':
-        font_color = (0, 0, 0)
-    elif font_color_str.lower() == 'red':
-        font_color = (255, 0, 0)
-    elif font_color_str.lower() == 'green':
-        font_color = (0, 255, 0)
-    elif font_color_str.lower() == 'blue':
-        font_color = (0, 0, 255)
-    else:
-        # 尝试解析RGB格式
-        try:
-            font_color = tuple(map(int, font_color_str.split(',')))
-            if len(font_color) != 3 or not all(0 <= c <= 255 for c in font_color):
-                raise ValueError
-        except ValueError:
-            print(f"无效的颜色格式: {font_color_str}，使用默认白色")
-            font_color = (255, 255, 255)
+        print(f"警告: 透明度值 {opacity} 超出范围，使用默认值 {DEFAULT_OPACITY}")
+        opacity = DEFAULT_OPACITY
+    
+    # 验证最大边长参数
+    if max_dim is not None and max_dim <= 0:
+        print(f"警告: 最大边长 {max_dim} 无效，不缩放图片")
+        max_dim = None
+    
+    # 字体颜色和透明度合并为绘制用的RGBA填充色
+    fill = parse_fill(font_color_str, opacity)
     
     # 检查输入路径
     if not os.path.exists(image_path):
         print(f"错误: 路径 {image_path} 不存在")
         return
     
+    # 处理后的图片保存在原目录下的“原目录名_watermark”子目录中
+    dir_path = os.path.dirname(image_path) if os.path.isfile(image_path) else image_path
+    output_dir = os.path.join(dir_path, f"{os.path.basename(dir_path)}_watermark")
+    
+    # 所有图片共用的参数只解析一次
+    job = WatermarkJob(
+        font=load_font(font_size),
+        fill=fill,
+        position_fn=POSITIONS[position],
+        out_dir=output_dir,
+        max_dim=max_dim,
+    )
+    
     # 确定是文件还是目录
     if os.path.isfile(image_path):
         # 单个文件处理
-        process_single_file(image_path, font_size, font_color, position, opacity)
+        process_single_file(image_path, job)
     else:
         # 目录处理
-        process_directory(image_path, font_size, font_color, position, opacity)
+        process_directory(image_path, job)
 
-def process_single_file(file_path, font_size, font_color, position, opacity):
+def process_single_file(file_path, job):
     """处理单个图片文件"""
     # 检查文件是否为图片
-    image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff']
     _, ext = os.path.splitext(file_path.lower())
-    if ext not in image_extensions:
+    if ext not in IMAGE_EXTS:
         print(f"跳过非图片文件: {file_path}")
         return
     
-    # 获取图片的目录和文件名
-    dir_path = os.path.dirname(file_path)
-    file_name = os.path.basename(file_path)
-    
     # 创建输出目录
-    output_dir = os.path.join(dir_path, f"{os.path.basename(dir_path)}_watermark")
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # 获取水印文本
-    datetime_obj = get_exif_datetime(file_path)
-    watermark_text = datetime_obj.strftime('%Y-%m-%d')
+    os.makedirs(job.out_dir, exist_ok=True)
     
     # 构建输出文件路径
-    output_path = os.path.join(output_dir, file_name)
+    output_path = os.path.join(job.out_dir, os.path.basename(file_path))
     
     # 添加水印并保存
-    add_watermark(file_path, output_path, watermark_text, font_size, font_color, position, opacity)
+    add_watermark(file_path, output_path, job)
 
-def process_directory(dir_path, font_size, font_color, position, opacity):
+def open_prefetched(file_path):
+    """打开文件并提示内核在后台预读其内容（仅在支持posix_fadvise的系统如Linux上生效），打开失败时返回None"""
+    try:
+        f = open(file_path, 'rb')
+    except OSError:
+        # 交给add_watermark按路径打开并报告错误
+        return None
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            # 预读只是优化，失败时忽略
+            pass
+    return f
+
+def process_directory(dir_path, job):
     """处理目录中的所有图片文件"""
     # 创建输出目录
-    output_dir = os.path.join(dir_path, f"{os.path.basename(dir_path)}_watermark")
-    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(job.out_dir, exist_ok=True)
     
-    # 遍历目录中的所有文件
-    for file_name in os.listdir(dir_path):
-        file_path = os.path.join(dir_path, file_name)
-        
-        # 跳过子目录
-        if os.path.isdir(file_path):
-            continue
-        
-        # 检查文件是否为图片
-        image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff']
-        _, ext = os.path.splitext(file_name.lower())
-        if ext not in image_extensions:
-            print(f"跳过非图片文件: {file_name}")
-            continue
-        
-        # 获取水印文本
-        datetime_obj = get_exif_datetime(file_path)
-        watermark_text = datetime_obj.strftime('%Y-%m-%d')
-        
-        # 构建输出文件路径
-        output_path = os.path.join(output_dir, file_name)
-        
-        # 添加水印并保存
-        add_watermark(file_path, output_path, watermark_text, font_size, font_color, position, opacity)
+    # 先筛选出所有图片文件，构建任务列表
+    # scandir读取目录时已带回文件类型，无需再对每个条目单独stat
+    tasks = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            # 跳过子目录
+            if not entry.is_file():
+                continue
+            
+            # 检查文件是否为图片
+            _, ext = os.path.splitext(entry.name.lower())
+            if ext not in IMAGE_EXTS:
+                print(f"跳过非图片文件: {entry.name}")
+                continue
+            
+            # 构建输出文件路径
+            output_path = os.path.join(job.out_dir, entry.name)
+            tasks.append((entry.path, output_path))
+    
+    # 先打开并预读前PREFETCH_DEPTH个文件，之后每提交一个任务再打开其后第PREFETCH_DEPTH个文件
+    # 预读时打开的文件对象直接交给处理线程，每个文件只open一次，同时打开的文件数也有上限
+    sources = {i: open_prefetched(file_path) for i, (file_path, _) in enumerate(tasks[:PREFETCH_DEPTH])}
+    
+    # Pillow解码和编码时会释放GIL，用线程池让各文件的磁盘读写与图片编解码重叠进行
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pending = set()
+        for i, (file_path, output_path) in enumerate(tasks):
+            if i + PREFETCH_DEPTH < len(tasks):
+                sources[i + PREFETCH_DEPTH] = open_prefetched(tasks[i + PREFETCH_DEPTH][0])
+            
+            # 未完成的任务达到上限时，等待至少一个完成后再继续提交
+            if len(pending) >= MAX_IN_FLIGHT:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.add(executor.submit(add_watermark, file_path, output_path, job, sources.pop(i)))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file